@@ -8,27 +8,79 @@ Requires that AWS credentials are already set up as described here:
 
 https://boto3.amazonaws.com/v1/documentation/api/latest/guide/quickstart.html
 
-Usage:
-  ec2_manager.py (--list | --start INSTANCE | --stop INSTANCE) [ --quiet | --verbose] [--test]
-
-Options:
-  -h --help                 Show this screen.
-  -v --version              Show version.
-  -l --list                 Lists all registered EC2 instances in the user's account.
-  --start=INSTANCE          Start an EC2 instance
-  --stop=INSTANCE           Stop an EC2 instance
-  --test                    Runs the program in test mode to check permissions. Does not stop or start instances.
-  --quiet                   Print less text
-  --verbose                 Print more text
 """
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Dict, List
-import boto3
-from botocore.exceptions import ClientError
-from docopt import docopt
+from itertools import islice
+from operator import itemgetter
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 VERSION = 0.1
+PARSE_WORKERS = 4
+INSTANCE_BATCH_SIZE = 50
+WAITER_DELAY = 5
+WAITER_MAX_ATTEMPTS = 40
+INSTANCE_STATES = (
+    "pending",
+    "running",
+    "shutting-down",
+    "terminated",
+    "stopping",
+    "stopped",
+)
+# Terminated instances hang around for a while after they're gone, so they're only
+# listed when asked for
+LISTED_STATES = tuple(s for s in INSTANCE_STATES if s != "terminated")
+# Adaptive retries rate limit on the client side when EC2 starts throttling
+CLIENT_CONFIG = {
+    "retries": {"max_attempts": 10, "mode": "adaptive"},
+    "max_pool_connections": 32,
+}
+# Fields DescribeInstances always returns, pulled out of an instance in one call
+REQUIRED_INSTANCE_FIELDS = itemgetter(
+    "ImageId", "InstanceId", "InstanceType", "LaunchTime"
+)
+
+# boto3 is imported on first use so --help and argument errors return quickly
+SESSION: Any = None
+CLIENT_CACHE: Dict[str, Any] = {}
+
+# Instance summaries for each output level, chosen once so listing an instance is a
+# single print call
+QUIET_SUMMARY = "{i.instance_id}"
+NORMAL_SUMMARY = "\n".join(
+    [
+        "{i.instance_id}",
+        "~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~",
+        "  Type:        {i.instance_type}",
+        "  Private IP:  {i.private_ip_address}",
+        "  Public IP:   {i.public_ip_address}",
+        "  State:       {i.state}",
+        "\n",
+    ]
+)
+VERBOSE_SUMMARY = "\n".join(
+    [
+        "{i.instance_id}",
+        "~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~",
+        "  AMI:         {i.image_id}",
+        "  Type:        {i.instance_type}",
+        "  Launched:    {i.launch_time}",
+        "  AZ:          {i.availability_zone}",
+        "  Private DNS: {i.private_dns_name}",
+        "  Public DNS:  {i.public_dns_name}",
+        "  Private IP:  {i.private_ip_address}",
+        "  Public IP:   {i.public_ip_address}",
+        "  Subnet Id:   {i.subnet_id}",
+        "  VPC Id:      {i.vpc_id}",
+        "  State:       {i.state}",
+        "  Tags:        {i.tags}",
+        "\n",
+    ]
+)
 
 
 @dataclass(eq=True, frozen=True)
@@ -37,10 +89,12 @@ class Settings:
     Simple class to capture command line args as settings that can be passed around
     """
 
-    instance_id: str
+    instance_ids: Optional[Tuple[str, ...]] = None
     test: bool = False
     verbose: bool = False
     quiet: bool = False
+    wait: bool = True
+    states: Tuple[str, ...] = LISTED_STATES
 
 
 @dataclass(eq=True, frozen=True)
@@ -49,6 +103,23 @@ class EC2Instance:
     Class to encapsulate EC2 instance details
     """
 
+    # One of these is kept per instance in the account, so skip the per-object __dict__
+    __slots__ = (
+        "image_id",
+        "instance_id",
+        "instance_type",
+        "launch_time",
+        "availability_zone",
+        "private_dns_name",
+        "private_ip_address",
+        "public_ip_address",
+        "public_dns_name",
+        "state",
+        "subnet_id",
+        "vpc_id",
+        "tags",
+    )
+
     image_id: str
     instance_id: str
     instance_type: str
@@ -63,149 +134,314 @@ class EC2Instance:
     vpc_id: str
     tags: List[Dict[str, str]]
 
+    # Frozen dataclasses with __slots__ can't be restored by copy or pickle through
+    # setattr, dataclass(slots=True) adds these on 3.10+ for the same reason
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            object.__setattr__(self, name, value)
+
+
+def cached_client(service: str) -> Any:
+    """
+    Returns a Boto3 client for the service, building it from the shared session on
+    first use. Building a client loads the service model and resolves credentials, so
+    each process should only pay for that once.
+    """
+    global SESSION
+    if service not in CLIENT_CACHE:
+        if SESSION is None:
+            import boto3
+
+            SESSION = boto3.session.Session()
+        from botocore.config import Config
+
+        CLIENT_CACHE[service] = SESSION.client(service, config=Config(**CLIENT_CONFIG))
+    return CLIENT_CACHE[service]
+
+
+def split_comma_separated(value: str) -> Tuple[str, ...]:
+    """
+    Turns a comma separated command line value, like a list of instance ids, into a
+    tuple
+    """
+    return tuple(i.strip() for i in value.split(",") if i.strip())
+
+
+def parse_args() -> argparse.Namespace:
+    """
+    Parses the command line arguments
+    """
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "-v", "--version", action="version", version=f"EC2 Manager {VERSION}"
+    )
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument(
+        "-l",
+        "--list",
+        action="store_true",
+        help="Lists all registered EC2 instances in the user's account.",
+    )
+    mode.add_argument(
+        "--start",
+        metavar="INSTANCE",
+        type=split_comma_separated,
+        help="Start EC2 instances (comma separated list of ids)",
+    )
+    mode.add_argument(
+        "--stop",
+        metavar="INSTANCE",
+        type=split_comma_separated,
+        help="Stop EC2 instances (comma separated list of ids)",
+    )
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument("--quiet", action="store_true", help="Print less text")
+    output.add_argument("--verbose", action="store_true", help="Print more text")
+    parser.add_argument(
+        "--test",
+        action="store_true",
+        help="Runs the program in test mode to check permissions. "
+        "Does not stop or start instances.",
+    )
+    parser.add_argument(
+        "--no-wait",
+        action="store_true",
+        help="Return as soon as the start or stop request is accepted "
+        "(--start/--stop only).",
+    )
+    parser.add_argument(
+        "--state",
+        metavar="STATES",
+        type=split_comma_separated,
+        help="Only list instances in these states (comma separated list, --list "
+        f"only). Defaults to {','.join(LISTED_STATES)}.",
+    )
+    args = parser.parse_args()
+    for option in ("start", "stop"):
+        if getattr(args, option) == ():
+            parser.error(f"argument --{option}: expected at least one instance id")
+    if args.list and args.no_wait:
+        parser.error("argument --no-wait: only allowed with --start/--stop")
+    if args.state is None:
+        args.state = LISTED_STATES
+    elif not args.list:
+        parser.error("argument --state: only allowed with --list")
+    elif not args.state:
+        parser.error("argument --state: expected at least one instance state")
+    if unknown := set(args.state) - set(INSTANCE_STATES):
+        parser.error(
+            f"unknown instance state {', '.join(sorted(unknown))}, "
+            f"choose from {', '.join(INSTANCE_STATES)}"
+        )
+    return args
+
 
 class EC2Manager:
     def __init__(self, settings: Settings):
         self._settings = settings
-        self.ec2 = boto3.client("ec2")
+        if settings.verbose:
+            self._summary_format = VERBOSE_SUMMARY
+        elif settings.quiet:
+            # the CLI lists quiet output through list_instance_ids, this is only for
+            # library callers of print_instance_summary
+            self._summary_format = QUIET_SUMMARY
+        else:
+            self._summary_format = NORMAL_SUMMARY
+        self.ec2 = cached_client("ec2")
 
     @property
     def settings(self):
         return self._settings
 
-    def list_instances(self) -> List[EC2Instance]:
+    def describe_pages(self) -> Iterator[Dict]:
         """
-        Lists all registered EC2 instances
+        Pages through the DescribeInstances results for the account, filtered
+        server side to the requested instance states
         """
-        boto_response = self.ec2.describe_instances()
-        instances = self.instance_from_response(boto_response)
-        return instances
+        paginator = self.ec2.get_paginator("describe_instances")
+        yield from paginator.paginate(
+            Filters=[
+                {"Name": "instance-state-name", "Values": list(self.settings.states)}
+            ],
+            PaginationConfig={"PageSize": 1000},
+        )
+
+    def list_instances(self) -> Iterator[EC2Instance]:
+        """
+        Lists all registered EC2 instances, yielding them as pages are unpacked
+        """
+        pending = deque()
+        # Unpack each page on a worker thread while the next page is being fetched
+        with ThreadPoolExecutor(max_workers=PARSE_WORKERS) as executor:
+            for page in self.describe_pages():
+                pending.append(executor.submit(list, self.instance_from_response(page)))
+                # at most PARSE_WORKERS pages are held at once, blocking on the
+                # oldest when full so memory stays bounded on large accounts
+                while pending and (len(pending) >= PARSE_WORKERS or pending[0].done()):
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+    def list_instance_ids(self) -> Iterator[str]:
+        """
+        Lists the ids of all registered EC2 instances, skipping the other details
+        """
+        for page in self.describe_pages():
+            yield from self.instance_ids_from_response(page)
 
     @staticmethod
-    def instance_from_response(response: Dict) -> List[EC2Instance]:
+    def instance_from_response(response: Dict) -> Iterator[EC2Instance]:
         """
         Unpacks the dictionary response from Boto3 and makes a nice dataclass with
         the some of the more useful details of the EC2 instance
-        :param response: Boto3 response from a call to boto3.client("ec2").describe_instances()
-        :return: List of EC2Instance objects
-        """
-        ec2_instances = []
-        for reservation in response.get("Reservations"):
-            for instance in reservation.get("Instances"):
-                if dns := instance.get("PublicDnsName"):
-                    public_dns_name = dns
-                else:
-                    public_dns_name = "NONE"
-                if ip := instance.get("PublicIpAddress"):
-                    public_ip_address = ip
-                else:
-                    public_ip_address = "NONE"
-                ec2_instance = EC2Instance(
-                    image_id=instance.get("ImageId"),
-                    instance_id=instance.get("InstanceId"),
-                    instance_type=instance.get("InstanceType"),
-                    launch_time=instance.get("LaunchTime"),
-                    availability_zone=instance.get("Placement").get("AvailabilityZone"),
-                    private_dns_name=instance.get("PrivateDnsName"),
-                    private_ip_address=instance.get("PrivateIpAddress"),
-                    public_dns_name=public_dns_name,
-                    public_ip_address=public_ip_address,
-                    state=instance.get("State").get("Name"),
-                    subnet_id=instance.get("SubnetId"),
-                    vpc_id=instance.get("VpcId"),
-                    tags=instance.get("Tags"),
+        :param response: Boto3 response (or a single page of one) from a call to
+            boto3.client("ec2").describe_instances()
+        :return: Generator of EC2Instance objects
+        """
+        for reservation in response.get("Reservations") or []:
+            for instance in reservation.get("Instances") or []:
+                get = instance.get
+                image_id, instance_id, instance_type, launch_time = (
+                    REQUIRED_INSTANCE_FIELDS(instance)
+                )
+                yield EC2Instance(
+                    image_id=image_id,
+                    instance_id=instance_id,
+                    instance_type=instance_type,
+                    launch_time=launch_time,
+                    availability_zone=(get("Placement") or {}).get("AvailabilityZone"),
+                    private_dns_name=get("PrivateDnsName"),
+                    private_ip_address=get("PrivateIpAddress"),
+                    public_dns_name=get("PublicDnsName") or "NONE",
+                    public_ip_address=get("PublicIpAddress") or "NONE",
+                    state=(get("State") or {}).get("Name"),
+                    subnet_id=get("SubnetId"),
+                    vpc_id=get("VpcId"),
+                    tags=get("Tags"),
                 )
-                ec2_instances.append(ec2_instance)
 
-        return ec2_instances
+    @staticmethod
+    def instance_ids_from_response(response: Dict) -> Iterator[str]:
+        """
+        Pulls just the instance ids out of the dictionary response from Boto3
+        :param response: Boto3 response (or a single page of one) from a call to
+            boto3.client("ec2").describe_instances()
+        :return: Generator of instance ids
+        """
+        for reservation in response.get("Reservations") or []:
+            for instance in reservation.get("Instances") or []:
+                yield instance.get("InstanceId")
 
     def print_instance_summary(self, instance: EC2Instance):
         """
         Prints summary of EC2 instance details
         """
-        print(instance.instance_id)
-        self.not_quiet("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-        self.verbose_output(f"  AMI:         {instance.image_id}")
-        self.not_quiet(f"  Type:        {instance.instance_type}")
-        self.verbose_output(f"  Launched:    {instance.launch_time}")
-        self.verbose_output(f"  AZ:          {instance.availability_zone}")
-        self.verbose_output(f"  Private DNS: {instance.private_dns_name}")
-        self.verbose_output(f"  Public DNS:  {instance.public_dns_name}")
-        self.not_quiet(f"  Private IP:  {instance.private_ip_address}")
-        self.not_quiet(f"  Public IP:   {instance.public_ip_address}")
-        self.verbose_output(f"  Subnet Id:   {instance.subnet_id}")
-        self.verbose_output(f"  VPC Id:      {instance.vpc_id}")
-        self.not_quiet(f"  State:       {instance.state}")
-        self.verbose_output(f"  Tags:        {instance.tags}")
-        self.not_quiet("\n")
+        print(self._summary_format.format(i=instance))
 
     def start(self):
         """
-        Start an EC2 instance
+        Start one or more EC2 instances
         :return: none
         """
-        # Dry run to verify permissions
-        try:
-            self.ec2.start_instances(
-                InstanceIds=[self.settings.instance_id], DryRun=True
-            )
-        except ClientError as e:
-            if "DryRunOperation" not in str(e):
-                if self.settings.test:
-                    print(f"Test failed, can't start {self.settings.instance_id}.\n{e}")
-            else:
-                if self.settings.test:
-                    print(
-                        f"Test successful, able to start {self.settings.instance_id}."
-                    )
-
-        if self.settings.test:
-            return
-
-        # Dry run succeeded, run start_instances without dry run
-        try:
-            self.ec2.start_instances(
-                InstanceIds=[self.settings.instance_id], DryRun=False
-            )
-        except ClientError as e:
-            print(f"ERROR: {e}")
-        else:
-            print(f"Command successful, {self.settings.instance_id} is staring...")
+        from botocore.exceptions import ClientError
+
+        accepted = []
+        for batch in self.instance_batches():
+            instance_ids = ", ".join(batch)
+            if self.settings.test:
+                # Dry run to verify permissions, only needed in test mode
+                try:
+                    self.ec2.start_instances(InstanceIds=batch, DryRun=True)
+                except ClientError as e:
+                    if "DryRunOperation" not in str(e):
+                        print(f"Test failed, can't start {instance_ids}.\n{e}")
+                    else:
+                        print(f"Test successful, able to start {instance_ids}.")
+                continue
+
+            try:
+                self.ec2.start_instances(InstanceIds=batch, DryRun=False)
+            except ClientError as e:
+                print(f"ERROR: {e}")
+                continue
+            print(f"Command successful, {instance_ids} is staring...")
+            accepted.append(batch)
+
+        if self.settings.wait:
+            for batch in accepted:
+                self.wait_for_state(batch, "running")
 
     def stop(self):
         """
-        Stop an EC2 instance
+        Stop one or more EC2 instances
         :return: none
         """
-        # Dry run to verify permissions
-        try:
-            self.ec2.stop_instances(
-                InstanceIds=[self.settings.instance_id], DryRun=True
-            )
-        except ClientError as e:
-            if "DryRunOperation" not in str(e):
-                if self.settings.test:
-                    print(f"Test failed, can't stop {self.settings.instance_id}.\n{e}")
-            else:
-                if self.settings.test:
-                    print(f"Test successful, able to stop {self.settings.instance_id}.")
-
-        if self.settings.test:
-            return
-
-        # Dry run succeeded, run start_instances without dry run
+        from botocore.exceptions import ClientError
+
+        accepted = []
+        for batch in self.instance_batches():
+            instance_ids = ", ".join(batch)
+            if self.settings.test:
+                # Dry run to verify permissions, only needed in test mode
+                try:
+                    self.ec2.stop_instances(InstanceIds=batch, DryRun=True)
+                except ClientError as e:
+                    if "DryRunOperation" not in str(e):
+                        print(f"Test failed, can't stop {instance_ids}.\n{e}")
+                    else:
+                        print(f"Test successful, able to stop {instance_ids}.")
+                continue
+
+            try:
+                self.ec2.stop_instances(InstanceIds=batch, DryRun=False)
+            except ClientError as e:
+                print(f"ERROR: {e}")
+                continue
+            print(f"Command successful, {instance_ids} is stopping...")
+            accepted.append(batch)
+
+        if self.settings.wait:
+            for batch in accepted:
+                self.wait_for_state(batch, "stopped")
+
+    def wait_for_state(self, instance_ids: List[str], state: str):
+        """
+        Blocks until the given instances reach the requested state using a Boto3 waiter
+        :param instance_ids: ids of the instances to wait on
+        :param state: "running" or "stopped"
+        :return: none
+        """
+        from botocore.exceptions import WaiterError
+
+        waiter = self.ec2.get_waiter(f"instance_{state}")
         try:
-            self.ec2.stop_instances(
-                InstanceIds=[self.settings.instance_id], DryRun=False
+            waiter.wait(
+                InstanceIds=instance_ids,
+                WaiterConfig={
+                    "Delay": WAITER_DELAY,
+                    "MaxAttempts": WAITER_MAX_ATTEMPTS,
+                },
             )
-        except ClientError as e:
+        except WaiterError as e:
             print(f"ERROR: {e}")
         else:
-            print(f"Command successful, {self.settings.instance_id} is stopping...")
+            print(f"{', '.join(instance_ids)} is {state}.")
 
-    def verbose_output(self, message: str):
-        if self.settings.verbose:
-            print(message)
+    def instance_batches(self) -> Iterator[List[str]]:
+        """
+        Splits the requested instance ids into batches so large fleets are
+        started or stopped with a handful of API calls instead of one per instance
+        """
+        if self.settings.instance_ids is None:
+            raise ValueError("start/stop require instance_ids")
+        ids = iter(self.settings.instance_ids)
+        while batch := list(islice(ids, INSTANCE_BATCH_SIZE)):
+            yield batch
 
     def not_quiet(self, message: str):
         if not self.settings.quiet:
@@ -213,37 +449,34 @@ class EC2Manager:
 
 
 if __name__ == "__main__":
-    args = docopt(__doc__, version=f"EC2 Manager {VERSION}")
-    list_mode = args.get("--list")
+    args = parse_args()
+    flag_kwargs = dict(
+        test=args.test,
+        wait=not args.no_wait,
+        states=args.state,
+        verbose=args.verbose,
+        quiet=args.quiet,
+    )
+    list_mode = args.list
     if not list_mode:
-        if instance_id := args.get("--start"):
-            app_settings = Settings(
-                instance_id=instance_id,
-                test=args.get("--test"),
-                verbose=args.get("--verbose"),
-                quiet=args.get("--quiet"),
-            )
+        if args.start is not None:
+            app_settings = Settings(instance_ids=args.start, **flag_kwargs)
             manager = EC2Manager(app_settings)
             manager.start()
         else:
-            app_settings = Settings(
-                instance_id=args.get("--stop"),
-                test=args.get("--test"),
-                verbose=args.get("--verbose"),
-                quiet=args.get("--quiet"),
-            )
+            app_settings = Settings(instance_ids=args.stop, **flag_kwargs)
             manager = EC2Manager(app_settings)
             manager.stop()
     else:
         # just list instances and quit
-        app_settings = Settings(
-            instance_id="",
-            test=args.get("--test"),
-            verbose=args.get("--verbose"),
-            quiet=args.get("--quiet"),
-        )
+        app_settings = Settings(**flag_kwargs)
         manager = EC2Manager(app_settings)
         manager.not_quiet("Instances found in your AWS account:\n")
-        all_instances = manager.list_instances()
-        for i in all_instances:
-            manager.print_instance_summary(instance=i)
+        if app_settings.quiet:
+            # only the ids are printed, so skip building the full instance details
+            for instance_id in manager.list_instance_ids():
+                print(instance_id)
+        else:
+            all_instances = manager.list_instances()
+            for i in all_instances:
+                manager.print_instance_summary(instance=i)